@@ -3,13 +3,100 @@
 Code-Editing Agent in Python with OpenAI API
 """
 
-import json
+import argparse
+import asyncio
+import hashlib
 import os
+import select
+import shutil
 import sys
-from typing import List, Dict, Any, Callable, Optional, Tuple
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Iterable, Optional, Tuple
 from dataclasses import dataclass
 from pathlib import Path
-from openai import OpenAI
+import orjson
+import tiktoken
+from openai import AsyncOpenAI, AsyncStream, DefaultAioHttpClient
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionMessage,
+    ChatCompletionMessageToolCall,
+)
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+# Number of responses kept by the exact-match response cache (--response-cache)
+RESPONSE_CACHE_SIZE = int(os.environ.get("AGENT_RESPONSE_CACHE_SIZE", "512"))
+
+# Turns loaded back from the --history log on start
+HISTORY_RESUME_TURNS = 20
+
+# read_file returns at most this many bytes (~4k tokens, half of the 8000-token
+# history budget) so one large file can't blow the budget on its own
+READ_FILE_MAX_BYTES = 16 * 1024
+
+
+class SemanticCache:
+    """Reuse text replies for user messages that are paraphrases of earlier ones.
+    
+    Messages are embedded locally with a small ONNX model (via fastembed) and
+    compared by cosine similarity against every stored message. With a path, entries
+    are kept in a JSONL file (one embedding and reply per line) so later runs reuse them.
+    """
+    
+    def __init__(self, path: Optional[str] = None, threshold: float = 0.93,
+                 model_name: str = "BAAI/bge-small-en-v1.5"):
+        # Optional dependencies, only needed with --semantic-cache
+        import numpy as np
+        from fastembed import TextEmbedding
+        
+        self._np = np
+        self._model = TextEmbedding(model_name)
+        self.threshold = threshold
+        self._vectors = None  # one unit-length embedding per row
+        self._responses: List[str] = []
+        
+        self._file = None
+        if path:
+            if os.path.exists(path):
+                rows = []
+                with open(path, "rb") as f:
+                    for line in f:
+                        try:
+                            entry = orjson.loads(line)
+                        except orjson.JSONDecodeError:
+                            continue  # blank, or torn by a crash mid-write
+                        rows.append(entry["vector"])
+                        self._responses.append(entry["content"])
+                if rows:
+                    self._vectors = np.array(rows, dtype=np.float32)
+            self._file = _open_log(path)
+    
+    def embed(self, text: str):
+        vector = next(iter(self._model.embed([text])))
+        return vector / self._np.linalg.norm(vector)
+    
+    def lookup(self, vector) -> Optional[str]:
+        if self._vectors is None:
+            return None
+        scores = self._vectors @ vector
+        best = int(scores.argmax())
+        return self._responses[best] if scores[best] > self.threshold else None
+    
+    def add(self, vector, content: str):
+        row = vector[self._np.newaxis, :]
+        self._vectors = row if self._vectors is None else self._np.vstack([self._vectors, row])
+        self._responses.append(content)
+        if self._file:
+            entry = {"vector": vector, "content": content}
+            self._file.write(orjson.dumps(entry, option=orjson.OPT_SERIALIZE_NUMPY).decode() + "\n")
+    
+    def close(self):
+        if self._file:
+            self._file.close()
 
 
 @dataclass
@@ -18,16 +105,74 @@ class ToolDefinition:
     description: str
     parameters: Dict[str, Any]
     function: Callable[[Dict[str, Any]], str]
+    # Tools that only look at files can run alongside others on the same path
+    read_only: bool = False
 
 
 class Agent:
-    def __init__(self, client: OpenAI, get_user_message: Callable[[], Tuple[str, bool]], tools: List[ToolDefinition]):
+    def __init__(self, client: AsyncOpenAI, get_user_message: Callable[[], Tuple[str, bool]], tools: List[ToolDefinition],
+                 semantic_cache: Optional[SemanticCache] = None,
+                 get_pending_messages: Optional[Callable[[], List[str]]] = None,
+                 history_path: Optional[str] = None,
+                 response_cache_path: Optional[str] = None):
         self.client = client
         self.get_user_message = get_user_message
+        self.get_pending_messages = get_pending_messages
         self.tools = tools
+        self.semantic_cache = semantic_cache
+        self.default_model = "gpt-4-turbo-preview"
+        # Cheaper, faster model for summarizing short tool results after a tool turn
+        self.small_model = "gpt-4o-mini"
+        self.small_model_max_tool_chars = 2000
+        
+        # Oldest turns are dropped once the history grows past this many tokens
+        self.max_history_tokens = 8000
+        self.keep_system_prefix = True
+        
+        # Conversation history, with each message's token count kept alongside
+        # so trimming never has to re-encode the whole history
+        self.messages: List[Dict[str, Any]] = []
+        self._encoding = tiktoken.encoding_for_model(self.default_model)
+        self._token_counts: List[int] = []
+        self._history_tokens = 0
+        
+        # Convert our tools to OpenAI's format once instead of on every request
+        self._openai_tools = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": tool.parameters
+                }
+            }
+            for tool in tools
+        ] or None
+        self._tool_map = {tool.name: tool for tool in tools}
+        # Tools do blocking file I/O; a dedicated pool lets a turn's calls overlap
+        self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tool")
+        
+        # Optional responses keyed by a hash of the exact request, least recently used
+        # first. They are kept in a JSONL file, so re-running the same session replays
+        # its replies instead of calling the API again.
+        self._response_cache: "OrderedDict[bytes, ChatCompletionMessage]" = OrderedDict()
+        self._response_cache_file = None
+        if response_cache_path:
+            if os.path.exists(response_cache_path):
+                self._response_cache = _load_response_cache(response_cache_path, RESPONSE_CACHE_SIZE)
+            self._response_cache_file = _open_log(response_cache_path)
+        
+        # Optional on-disk log of every message (one JSON object per line). On start
+        # the most recent turns are loaded back; older ones stay on disk only.
+        self._history_file = None
+        if history_path:
+            if os.path.exists(history_path):
+                for message in _load_recent_turns(history_path, HISTORY_RESUME_TURNS):
+                    self._append(message)
+                self._trim()
+            self._history_file = _open_log(history_path)
     
-    def run(self):
-        messages = []
+    async def run(self):
         print("Chat with GPT (use 'ctrl-c' to quit)")
         
         try:
@@ -37,111 +182,560 @@ class Agent:
                 if not ok:
                     break
                 
+                # Several lines pasted at once are sent as one request asking for
+                # one answer per line, so the shared history is only paid for once
+                pending = [user_input]
+                if self.get_pending_messages:
+                    pending.extend(self.get_pending_messages())
+                batched = len(pending) > 1
+                if batched:
+                    user_input = _batch_prompt(pending)
+                
+                # Nothing earlier in the conversation can change what this message means
+                stateless = not self.messages
+                
                 # Add user message
-                messages.append({
+                self._append({
                     "role": "user",
                     "content": user_input
                 })
+                self._trim()
+                
+                # Get response from OpenAI, or from the semantic cache for a paraphrase
+                # of an opening message from this or an earlier run. Only plain text
+                # replies are cached: a tool plan carries arguments built for the
+                # earlier wording.
+                response = None
+                vector = None
+                if self.semantic_cache and stateless and not batched:
+                    vector = self.semantic_cache.embed(user_input)
+                    cached = self.semantic_cache.lookup(vector)
+                    if cached is not None:
+                        response = ChatCompletionMessage(role="assistant", content=cached)
+                        self._print_reply(cached)
+                # Tool calls that finish streaming early start running right away.
+                # Identical read-only calls with no write between them share a single
+                # run, and calls touching the same path wait for the earlier ones.
+                started: Dict[str, asyncio.Task] = {}
+                by_signature: Dict[Tuple[str, bytes], asyncio.Task] = {}
+                last_by_path: Dict[str, asyncio.Task] = {}
+                
+                def start_tool(tool_call, arguments):
+                    name = tool_call.function.name
+                    signature = (name, orjson.dumps(arguments, option=orjson.OPT_SORT_KEYS))
+                    if signature in by_signature:
+                        started[tool_call.id] = by_signature[signature]
+                        return
+                    
+                    paths = self._tool_paths(name, arguments)
+                    after = {last_by_path[path] for path in paths if path in last_by_path}
+                    task = asyncio.create_task(self._execute_tool(tool_call.id, name, arguments, after=after))
+                    for path in paths:
+                        last_by_path[path] = task
+                    if self._is_read_only(name):
+                        by_signature[signature] = task
+                    else:
+                        # Anything read before this write may be stale afterwards
+                        by_signature.clear()
+                    started[tool_call.id] = task
+                
+                # Only reads start mid-stream: a write waits for the stream to finish so a
+                # failed stream never leaves a file changed with no record of the call,
+                # and every call after it waits too so nothing overtakes the write
+                eager = True
                 
-                # Get response from OpenAI
-                response = self._run_inference(messages)
+                def start_early(tool_call, arguments):
+                    nonlocal eager
+                    eager = eager and self._is_read_only(tool_call.function.name)
+                    if eager:
+                        start_tool(tool_call, arguments)
                 
-                # Add assistant message
-                messages.append({
+                if response is None:
+                    response = await self._run_inference(self.messages, echo=not batched, on_tool_call=start_early)
+                    if vector is not None and response.content and not response.tool_calls:
+                        self.semantic_cache.add(vector, response.content)
+                
+                # Add assistant message, keeping only plain JSON types in the history
+                assistant_message = {
                     "role": "assistant",
-                    "content": response.choices[0].message.content,
-                    "tool_calls": response.choices[0].message.tool_calls
-                })
+                    "content": response.content
+                }
+                if response.tool_calls:
+                    assistant_message["tool_calls"] = [tool_call.model_dump() for tool_call in response.tool_calls]
+                self._append(assistant_message)
                 
                 # Check if assistant wants to use tools
-                if response.choices[0].message.tool_calls:
-                    # Execute all requested tools
-                    for tool_call in response.choices[0].message.tool_calls:
-                        tool_result = self._execute_tool(
-                            tool_call.id,
-                            tool_call.function.name,
-                            json.loads(tool_call.function.arguments)
-                        )
-                        
+                if response.tool_calls:
+                    # Execute all requested tools concurrently, picking up the ones
+                    # already started while the response was streaming
+                    tool_calls = response.tool_calls
+                    for tool_call in tool_calls:
+                        if tool_call.id not in started:
+                            start_tool(tool_call, orjson.loads(tool_call.function.arguments))
+                    tool_results = await asyncio.gather(*(started[tool_call.id] for tool_call in tool_calls))
+                    
+                    for tool_call, tool_result in zip(tool_calls, tool_results):
                         # Add tool result to messages
-                        messages.append({
+                        self._append({
                             "role": "tool",
                             "tool_call_id": tool_call.id,
                             "content": tool_result
                         })
+                    self._trim()
                     
-                    # Get final response after tool execution
-                    final_response = self._run_inference(messages)
-                    messages.append({
+                    # Get final response after tool execution (printed as it streams).
+                    # Short tool output only needs relaying, which the small model does well.
+                    tool_chars = sum(len(tool_result) for tool_result in tool_results)
+                    model = self.small_model if tool_chars < self.small_model_max_tool_chars else None
+                    final_response = await self._run_inference(self.messages, model=model, echo=not batched)
+                    self._append({
                         "role": "assistant",
-                        "content": final_response.choices[0].message.content
+                        "content": final_response.content
                     })
-                    
-                    print(f"\033[93mGPT\033[0m: {final_response.choices[0].message.content}")
-                else:
-                    # No tools used, just print the response
-                    print(f"\033[93mGPT\033[0m: {response.choices[0].message.content}")
+                    response = final_response
+                
+                if batched:
+                    self._print_batch_replies(pending, response.content)
                 
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
             print("\nGoodbye!")
             return
     
-    def _run_inference(self, messages: List[Dict[str, Any]]):
-        # Convert our tools to OpenAI's format
-        tools = []
-        for tool in self.tools:
-            tools.append({
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.parameters
-                }
-            })
+    def close(self):
+        self._pool.shutdown(wait=False)
+        if self.semantic_cache:
+            self.semantic_cache.close()
+        if self._response_cache_file:
+            self._response_cache_file.close()
+        if self._history_file:
+            self._history_file.close()
+    
+    def _append(self, message: Dict[str, Any]):
+        tokens = _count_tokens(self._encoding, message)
+        self.messages.append(message)
+        self._token_counts.append(tokens)
+        self._history_tokens += tokens
+        if self._history_file:
+            self._history_file.write(orjson.dumps(message).decode() + "\n")
+    
+    def _trim(self):
+        """Drop the oldest turns until the history fits in max_history_tokens."""
+        messages = self.messages
+        start = 1 if self.keep_system_prefix and messages and messages[0]["role"] == "system" else 0
+        
+        while self._history_tokens > self.max_history_tokens:
+            # Evict a whole turn (a user message up to the next one) at a time so an
+            # assistant tool call is never separated from its tool results
+            next_turn = next(
+                (i for i in range(start + 1, len(messages)) if messages[i]["role"] == "user"),
+                None
+            )
+            if next_turn is None:
+                break  # only the current turn is left
+            self._history_tokens -= sum(self._token_counts[start:next_turn])
+            del messages[start:next_turn]
+            del self._token_counts[start:next_turn]
+    
+    async def _run_inference(self, messages: List[Dict[str, Any]], *,
+                             model: Optional[str] = None, echo: bool = True,
+                             on_tool_call: Optional[Callable[[ChatCompletionMessageToolCall, Dict[str, Any]], None]] = None
+                             ) -> ChatCompletionMessage:
+        """Stream a completion, printing its text as it arrives (unless echo is off), and return the assembled message.
+        
+        on_tool_call, if given, is called with each tool call and its parsed arguments
+        as soon as the call is complete, before the rest of the stream arrives. Calls
+        are handed over in model order; one whose arguments never parse holds back
+        the rest, which the caller then picks up from the returned message.
+        """
+        model = model or self.default_model
+        
+        # Identical requests (same model, history and tools) reuse the earlier reply
+        key = self._cache_key(model, messages) if self._response_cache_file else None
+        if key in self._response_cache:
+            self._response_cache.move_to_end(key)
+            message = self._response_cache[key]
+            if echo:
+                self._print_reply(message.content)
+            return message
         
-        response = self.client.chat.completions.create(
-            model="gpt-4-turbo-preview",  # or "gpt-3.5-turbo" for lower cost
-            messages=messages,
-            tools=tools if tools else None,
-            tool_choice="auto"  # Let the model decide when to use tools
+        # The history is already plain JSON, so post it as-is rather than through
+        # chat.completions.create(), which re-walks every message to validate it
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": True
+        }
+        if self._openai_tools:
+            payload["tools"] = self._openai_tools
+            payload["tool_choice"] = "auto"  # Let the model decide when to use tools
+        stream = await self.client.post(
+            "/chat/completions",
+            body=payload,
+            cast_to=ChatCompletion,
+            stream=True,
+            stream_cls=AsyncStream[ChatCompletionChunk]
+        )
+        
+        # Echoed text is collected and written in batches rather than flushed per token
+        out = sys.stdout.buffer
+        encoding = sys.stdout.encoding or "utf-8"
+        buf = bytearray()
+        buffered_tokens = 0
+        last_flush = time.monotonic()
+        
+        def flush_echo():
+            nonlocal buffered_tokens, last_flush
+            sys.stdout.flush()  # keep ordering with anything written via print()
+            out.write(buf)
+            out.flush()
+            buf.clear()
+            buffered_tokens = 0
+            last_flush = time.monotonic()
+        
+        content = []
+        tool_calls: Dict[int, Dict[str, str]] = {}
+        next_dispatch = 0  # calls are handed off strictly in index order
+        line_open = False  # an echoed reply line still needs its newline
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            
+            if delta.content:
+                if echo:
+                    if not line_open:
+                        buf += "\033[93mGPT\033[0m: ".encode(encoding)
+                        line_open = True
+                    buf += delta.content.encode(encoding, errors="replace")
+                    buffered_tokens += 1
+                content.append(delta.content)
+            
+            # Tool calls arrive in pieces keyed by index: the id and name come
+            # first, then the arguments JSON a fragment at a time
+            for tool_call in delta.tool_calls or []:
+                entry = tool_calls.setdefault(tool_call.index, {"id": "", "name": "", "arguments": ""})
+                if tool_call.id:
+                    entry["id"] = tool_call.id
+                if tool_call.function and tool_call.function.name:
+                    entry["name"] += tool_call.function.name
+                if tool_call.function and tool_call.function.arguments:
+                    entry["arguments"] += tool_call.function.arguments
+                
+                # Once a call's arguments parse as a complete JSON object, hand it off
+                # so it can run while the model is still generating the rest
+                if (on_tool_call and tool_call.index == next_dispatch
+                        and entry["arguments"].rstrip().endswith("}")):
+                    try:
+                        arguments = orjson.loads(entry["arguments"])
+                    except orjson.JSONDecodeError:
+                        continue
+                    next_dispatch += 1
+                    if line_open:
+                        buf += b"\n"
+                        line_open = False
+                    if buf:
+                        flush_echo()
+                    on_tool_call(_make_tool_call(entry), arguments)
+            
+            # Checked on every chunk, so buffered text still goes out on time while
+            # the model streams tool-call arguments rather than text
+            if buf and (buffered_tokens >= 32 or time.monotonic() - last_flush >= 0.05):
+                flush_echo()
+        
+        if line_open:
+            buf += b"\n"
+        if buf:
+            flush_echo()
+        
+        message = ChatCompletionMessage(
+            role="assistant",
+            content="".join(content) or None,
+            tool_calls=[_make_tool_call(entry) for _, entry in sorted(tool_calls.items())] or None
         )
         
-        return response
+        if key is not None:
+            self._response_cache[key] = message
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+            entry = {"key": key.hex(), "message": message.model_dump(mode="json")}
+            self._response_cache_file.write(orjson.dumps(entry).decode() + "\n")
+        
+        return message
     
-    def _execute_tool(self, tool_call_id: str, name: str, arguments: Dict[str, Any]) -> str:
-        # Find the tool
-        tool_def = None
-        for tool in self.tools:
-            if tool.name == name:
-                tool_def = tool
-                break
+    def _print_reply(self, content: Optional[str]):
+        if content:
+            print(f"\033[93mGPT\033[0m: {content}")
+    
+    def _print_batch_replies(self, requests: List[str], content: Optional[str]):
+        text = (content or "").strip()
+        if text.startswith("```"):
+            text = text.strip("`").removeprefix("json")
+        try:
+            answers = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            answers = None
         
+        if not isinstance(answers, list) or len(answers) != len(requests):
+            # The model ignored the requested format; show its reply as-is
+            self._print_reply(content)
+            return
+        
+        for i, answer in enumerate(answers, 1):
+            if not isinstance(answer, str):
+                answer = orjson.dumps(answer).decode()
+            print(f"\033[93mGPT\033[0m [{i}]: {answer}")
+    
+    def _cache_key(self, model: str, messages: List[Dict[str, Any]]) -> bytes:
+        payload = orjson.dumps(
+            {"m": model, "msgs": messages, "tools": self._openai_tools},
+            option=orjson.OPT_SORT_KEYS
+        )
+        return hashlib.blake2b(payload).digest()
+    
+    def _is_read_only(self, name: str) -> bool:
+        tool_def = self._tool_map.get(name)
+        return bool(tool_def and tool_def.read_only)
+    
+    def _tool_paths(self, name: str, arguments: Dict[str, Any]) -> List[str]:
+        """Paths a tool call touches; a write also touches its directory's listing."""
+        tool_def = self._tool_map.get(name)
+        if not tool_def:
+            return []
+        path = os.path.realpath(arguments.get("path") or ".")
+        return [path] if tool_def.read_only else [path, os.path.dirname(path)]
+    
+    async def _execute_tool(self, tool_call_id: str, name: str, arguments: Dict[str, Any],
+                            after: Iterable[asyncio.Task] = ()) -> str:
+        tool_def = self._tool_map.get(name)
         if not tool_def:
             return "Error: tool not found"
         
-        print(f"\033[92mtool\033[0m: {name}({json.dumps(arguments)})")
+        # Earlier calls on the same path go first; their outcome doesn't matter here
+        after = list(after)
+        if after:
+            await asyncio.wait(after)
+        
+        print(f"\033[92mtool\033[0m: {name}({orjson.dumps(arguments).decode()})")
         
         try:
-            response = tool_def.function(arguments)
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(self._pool, tool_def.function, arguments)
             return response
         except Exception as e:
             return f"Error: {str(e)}"
 
 
+def _make_tool_call(entry: Dict[str, str]) -> ChatCompletionMessageToolCall:
+    return ChatCompletionMessageToolCall(
+        id=entry["id"],
+        type="function",
+        function=Function(name=entry["name"], arguments=entry["arguments"])
+    )
+
+
+def _batch_prompt(requests: List[str]) -> str:
+    numbered = "\n".join(f"{i}. {request}" for i, request in enumerate(requests, 1))
+    return (
+        "Handle each of the following requests in order. When you are done, reply with only "
+        f"a JSON array of {len(requests)} strings: the answer to each request, in the same order.\n\n"
+        f"{numbered}"
+    )
+
+
+def _open_log(path: str):
+    """Open a JSONL log for appending, one line per write.
+    
+    A crash can leave the last line without its newline; one is added first so the
+    next message starts a line of its own instead of being glued onto the torn one.
+    """
+    with open(path, "ab+") as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    return open(path, "a", buffering=1, encoding="utf-8")
+
+
+def _load_response_cache(path: str, size: int) -> "OrderedDict[bytes, ChatCompletionMessage]":
+    """Load the newest `size` entries of a response cache file.
+    
+    The file only grows, so once it holds more than twice that many lines it is
+    rewritten with just the entries kept.
+    """
+    cache: "OrderedDict[bytes, ChatCompletionMessage]" = OrderedDict()
+    lines = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # blank, or torn by a crash mid-write
+            lines += 1
+            key = bytes.fromhex(entry["key"])
+            cache[key] = ChatCompletionMessage.model_validate(entry["message"])
+            cache.move_to_end(key)
+            if len(cache) > size:
+                cache.popitem(last=False)
+    
+    if lines > 2 * size:
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            for key, message in cache.items():
+                f.write(orjson.dumps({"key": key.hex(), "message": message.model_dump(mode="json")}) + b"\n")
+        os.replace(tmp_path, path)
+    return cache
+
+
+def _load_recent_turns(path: str, turns: int, skip: int = 0) -> List[Dict[str, Any]]:
+    """Load `turns` turns (each starting at a user message) from a history log,
+    ending `skip` turns before the most recent one.
+    
+    Lines torn by a crash mid-write are skipped, as are turns whose tool calls were
+    never answered, since the API rejects a tool call without its tool reply.
+    """
+    recent: "deque[List[Dict[str, Any]]]" = deque(maxlen=turns + skip)
+    turn: Optional[List[Dict[str, Any]]] = None  # None until the first user message
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                message = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            if message["role"] == "user":
+                if turn is not None and _turn_is_complete(turn):
+                    recent.append(turn)
+                turn = []
+            if turn is not None:  # skip a partial turn at the start of the file
+                turn.append(message)
+    if turn is not None and _turn_is_complete(turn):
+        recent.append(turn)
+    for _ in range(min(skip, len(recent))):
+        recent.pop()
+    return [message for turn in recent for message in turn]
+
+
+def _turn_is_complete(turn: List[Dict[str, Any]]) -> bool:
+    """Whether every tool call in the turn has a matching tool reply."""
+    called = {call["id"] for message in turn for call in message.get("tool_calls") or ()}
+    answered = {message.get("tool_call_id") for message in turn if message["role"] == "tool"}
+    return called <= answered
+
+
+def _count_tokens(encoding: "tiktoken.Encoding", message: Dict[str, Any]) -> int:
+    """Approximate the prompt tokens a message costs: its text plus any tool calls."""
+    tokens = len(encoding.encode(message.get("content") or ""))
+    if message.get("tool_calls"):
+        tokens += len(encoding.encode(orjson.dumps(message["tool_calls"]).decode()))
+    return tokens
+
+
 # Tool implementations
+
+# Tool calls from one turn run concurrently, so edits are serialized to keep
+# two read-modify-write cycles on the same file from clobbering each other.
+_EDIT_LOCK = threading.Lock()
+
+
+# Recently read files: (absolute path, offset) -> ((inode, mtime_ns, size), content),
+# least recently used first. Entries are dropped when edit_file rewrites the file.
+_READ_CACHE: "OrderedDict[Tuple[str, int], Tuple[Tuple[int, int, int], str]]" = OrderedDict()
+_READ_CACHE_SIZE = 128
+_READ_CACHE_LOCK = threading.Lock()
+
+
 def read_file(arguments: Dict[str, Any]) -> str:
     """Read the contents of a given relative file path."""
     path = arguments.get("path", "")
+    offset = arguments.get("offset", 0)
     if not path:
         raise ValueError("Path is required")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("offset must be a non-negative integer")
     
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return f.read()
+        st = os.stat(path)
+        key = (os.path.abspath(path), offset)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with _READ_CACHE_LOCK:
+            cached = _READ_CACHE.get(key)
+            if cached and cached[0] == signature:
+                _READ_CACHE.move_to_end(key)
+                return cached[1]
+        
+        content = _read_text(path, offset)
     except FileNotFoundError:
         raise FileNotFoundError(f"File not found: {path}")
     except Exception as e:
         raise Exception(f"Error reading file: {str(e)}")
+    
+    with _READ_CACHE_LOCK:
+        _READ_CACHE[key] = (signature, content)
+        if len(_READ_CACHE) > _READ_CACHE_SIZE:
+            _READ_CACHE.popitem(last=False)
+    return content
+
+
+def _read_text(path: str, offset: int = 0) -> str:
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset > size:
+            raise ValueError(f"offset {offset} is past the end of the file ({size} bytes)")
+        f.seek(offset)
+        # A partial read stops at the end of a line, so the next one picks up at a line start
+        truncated = size - offset > READ_FILE_MAX_BYTES
+        content = _normalize_newlines(_read_utf8(f, min(size - offset, READ_FILE_MAX_BYTES),
+                                                 errors='replace', whole_lines=truncated))
+        end = f.tell()
+    
+    if truncated:
+        content += (f"\n\n[truncated: showing bytes {offset}-{end} of {size}; "
+                    f"call read_file again with offset={end} to read on]")
+    return content
+
+
+def _normalize_newlines(text: str) -> str:
+    """Convert \r\n and lone \r to \n, as text mode would."""
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+# Per-thread scratch buffer that file reads go through, so the tool threads don't
+# allocate a fresh bytes object per read. Buffers past the cap aren't kept around.
+_READ_BUFFER = threading.local()
+_READ_BUFFER_MIN = 64 * 1024
+_READ_BUFFER_MAX = 1024 * 1024
+
+
+def _read_utf8(f, size: int, errors: str = 'strict', whole_lines: bool = False) -> str:
+    """Read up to size bytes from a binary file through the thread's buffer and decode them.
+    
+    With whole_lines, anything after the last newline read is given back (the file is
+    left positioned just past that newline), unless the bytes read hold no newline at all.
+    """
+    buf = getattr(_READ_BUFFER, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = bytearray(max(size, _READ_BUFFER_MIN))
+        if len(buf) <= _READ_BUFFER_MAX:
+            _READ_BUFFER.buf = buf
+    
+    with memoryview(buf) as view:
+        n = f.readinto(view[:size])
+        if whole_lines:
+            cut = buf.rfind(b"\n", 0, n) + 1
+            if cut:
+                f.seek(cut - n, os.SEEK_CUR)
+                n = cut
+        return str(view[:n], 'utf-8', errors)
+
+
+def _forget_read(path: str):
+    path = os.path.abspath(path)
+    with _READ_CACHE_LOCK:
+        for key in [key for key in _READ_CACHE if key[0] == path]:
+            del _READ_CACHE[key]
 
 
 def list_files(arguments: Dict[str, Any]) -> str:
@@ -156,15 +750,17 @@ def list_files(arguments: Dict[str, Any]) -> str:
             raise FileNotFoundError(f"Path not found: {path}")
         
         if path_obj.is_file():
-            return json.dumps([str(path_obj)])
+            return orjson.dumps([str(path_obj)]).decode()
         
-        for item in sorted(path_obj.iterdir()):
-            if item.is_dir():
-                files.append(f"{item.name}/")
-            else:
-                files.append(item.name)
+        # DirEntry.is_dir() answers from the readdir result, without a stat per entry
+        with os.scandir(path_obj) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir():
+                    files.append(f"{entry.name}/")
+                else:
+                    files.append(entry.name)
         
-        return json.dumps(files)
+        return orjson.dumps(files).decode()
     except Exception as e:
         raise Exception(f"Error listing files: {str(e)}")
 
@@ -181,6 +777,11 @@ def edit_file(arguments: Dict[str, Any]) -> str:
     if old_str == new_str:
         raise ValueError("old_str and new_str must be different")
     
+    with _EDIT_LOCK:
+        return _edit_file(path, old_str, new_str)
+
+
+def _edit_file(path: str, old_str: str, new_str: str) -> str:
     try:
         # If file doesn't exist and old_str is empty, create new file
         if not os.path.exists(path) and old_str == "":
@@ -188,21 +789,41 @@ def edit_file(arguments: Dict[str, Any]) -> str:
             os.makedirs(os.path.dirname(path), exist_ok=True) if os.path.dirname(path) else None
             with open(path, 'w', encoding='utf-8') as f:
                 f.write(new_str)
+            _forget_read(path)
             return f"Successfully created file {path}"
         
-        # Read existing file
-        with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        # Read existing file, normalizing newlines as text mode would
+        with open(path, 'rb') as f:
+            content = _normalize_newlines(_read_utf8(f, os.fstat(f.fileno()).st_size))
         
-        # Replace content
-        if old_str and old_str not in content:
-            raise ValueError("old_str not found in file")
+        # Replace the single occurrence of old_str; an empty old_str replaces the whole file
+        if old_str:
+            index = content.find(old_str)
+            if index < 0:
+                raise ValueError("old_str not found in file")
+            if content.find(old_str, index + 1) != -1:
+                raise ValueError("old_str matches more than once; include more surrounding text to make it unique")
+            new_content = content[:index] + new_str + content[index + len(old_str):]
+        else:
+            new_content = new_str
         
-        new_content = content.replace(old_str, new_str)
+        if new_content == content:
+            return "OK (no change)"
         
-        # Write back to file
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(new_content)
+        # Write to a sibling temp file and swap it in, so a crash never leaves a half-written file.
+        # Resolve symlinks first so the link's target is replaced, not the link itself.
+        target = os.path.realpath(path)
+        tmp_path = f"{target}.tmp.{os.getpid()}"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(new_content)
+            shutil.copymode(target, tmp_path)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        _forget_read(path)
         
         return "OK"
     
@@ -220,11 +841,16 @@ READ_FILE_DEFINITION = ToolDefinition(
             "path": {
                 "type": "string",
                 "description": "The relative path of a file in the working directory."
+            },
+            "offset": {
+                "type": "integer",
+                "description": "Optional byte offset to start reading from. Large files are returned in parts; the notice at the end of a part gives the offset of the next one."
             }
         },
         "required": ["path"]
     },
-    function=read_file
+    function=read_file,
+    read_only=True
 )
 
 LIST_FILES_DEFINITION = ToolDefinition(
@@ -239,13 +865,15 @@ LIST_FILES_DEFINITION = ToolDefinition(
             }
         }
     },
-    function=list_files
+    function=list_files,
+    read_only=True
 )
 
 EDIT_FILE_DEFINITION = ToolDefinition(
     name="edit_file",
     description="""Make edits to a text file.
 Replaces 'old_str' with 'new_str' in the given file. 'old_str' and 'new_str' MUST be different from each other.
+'old_str' must match exactly one place in the file.
 If the file specified with path doesn't exist, it will be created.""",
     parameters={
         "type": "object",
@@ -256,7 +884,7 @@ If the file specified with path doesn't exist, it will be created.""",
             },
             "old_str": {
                 "type": "string",
-                "description": "Text to search for - must match exactly"
+                "description": "Text to search for - must match exactly and only once"
             },
             "new_str": {
                 "type": "string",
@@ -269,6 +897,47 @@ If the file specified with path doesn't exist, it will be created.""",
 )
 
 
+def make_read_history_definition(path: str) -> ToolDefinition:
+    """A tool that reads older turns back from the --history log at `path`."""
+    
+    def read_history(arguments: Dict[str, Any]) -> str:
+        """Return the user and assistant text of a range of earlier turns."""
+        offset = arguments.get("offset", 0)
+        turns = arguments.get("turns", 5)
+        if not isinstance(offset, int) or offset < 0:
+            raise ValueError("offset must be a non-negative integer")
+        if not isinstance(turns, int) or turns < 1:
+            raise ValueError("turns must be a positive integer")
+        
+        messages = _load_recent_turns(path, turns, skip=offset)
+        return orjson.dumps([
+            {"role": message["role"], "content": message["content"]}
+            for message in messages
+            if message["role"] in ("user", "assistant") and message.get("content")
+        ]).decode()
+    
+    return ToolDefinition(
+        name="read_history",
+        description="Read earlier turns of this conversation that are no longer in context, from the saved history log. Returns the user and assistant messages of those turns, oldest first.",
+        parameters={
+            "type": "object",
+            "properties": {
+                "offset": {
+                    "type": "integer",
+                    "description": "How many of the most recent turns to skip before reading. 0 reads the latest turns; increase it to go further back."
+                },
+                "turns": {
+                    "type": "integer",
+                    "description": "How many turns to read. Defaults to 5."
+                }
+            },
+            "required": ["offset"]
+        },
+        function=read_history,
+        read_only=True
+    )
+
+
 def get_user_message() -> Tuple[str, bool]:
     """Get user input from stdin."""
     try:
@@ -278,9 +947,57 @@ def get_user_message() -> Tuple[str, bool]:
         return "", False
 
 
+def get_pending_user_messages() -> List[str]:
+    """Get any further lines already waiting on stdin, without blocking.
+    
+    Only done on a terminal: in canonical mode each read returns a single line, so
+    anything still unread is in the kernel where select can see it. From a pipe,
+    sys.stdin may already have buffered the next lines, and select would miss them.
+    """
+    pending = []
+    if not sys.stdin.isatty():
+        return pending
+    try:
+        while select.select([sys.stdin], [], [], 0.01)[0]:
+            line = sys.stdin.readline()
+            if not line:
+                break
+            pending.append(line.rstrip("\n"))
+    except (OSError, ValueError):
+        # stdin can't be polled (e.g. a Windows console); fall back to one line at a time
+        pass
+    return pending
+
+
 def main():
-    # Initialize OpenAI client (requires OPENAI_API_KEY environment variable)
-    client = OpenAI()
+    parser = argparse.ArgumentParser(description="Code-editing agent")
+    parser.add_argument("--semantic-cache", nargs="?", const=".agent_semantic_cache.jsonl", metavar="PATH",
+                        help="reuse replies to paraphrased opening messages, kept in PATH across runs "
+                             "(default: .agent_semantic_cache.jsonl; requires fastembed)")
+    parser.add_argument("--history", nargs="?", const=".agent_history.jsonl", metavar="PATH",
+                        help="log the conversation to PATH and resume from it on start "
+                             "(default: .agent_history.jsonl)")
+    parser.add_argument("--response-cache", nargs="?", const=".agent_response_cache.jsonl", metavar="PATH",
+                        help="replay replies to requests identical to earlier ones, kept in PATH across "
+                             "runs (default: .agent_response_cache.jsonl)")
+    args = parser.parse_args()
+    
+    # A resumed conversation never starts empty, so no message would be cacheable
+    if args.semantic_cache and args.history:
+        parser.error("--semantic-cache only applies to fresh conversations and can't be combined with --history")
+    
+    semantic_cache = None
+    if args.semantic_cache:
+        try:
+            semantic_cache = SemanticCache(args.semantic_cache)
+        except ImportError:
+            parser.error("--semantic-cache requires fastembed (pip install fastembed)")
+    
+    # Initialize OpenAI client (requires OPENAI_API_KEY environment variable).
+    # A single client keeps one pooled HTTP connection alive for the whole session;
+    # the aiohttp transport holds up under concurrent requests where httpx's
+    # default one does not.
+    client = AsyncOpenAI(http_client=DefaultAioHttpClient())
     
     # Define available tools
     tools = [
@@ -288,10 +1005,28 @@ def main():
         LIST_FILES_DEFINITION,
         EDIT_FILE_DEFINITION
     ]
+    if args.history:
+        tools.append(make_read_history_definition(args.history))
     
     # Create and run the agent
-    agent = Agent(client, get_user_message, tools)
-    agent.run()
+    agent = Agent(client, get_user_message, tools, semantic_cache=semantic_cache,
+                  get_pending_messages=get_pending_user_messages, history_path=args.history,
+                  response_cache_path=args.response_cache)
+    
+    # Drive the event loop by hand: asyncio.run() installs a SIGINT handler
+    # that cannot interrupt the blocking input() in get_user_message.
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(agent.run())
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # ctrl-c landed while awaiting the API; let run() unwind cleanly
+        task.cancel()
+        loop.run_until_complete(task)
+    finally:
+        agent.close()
+        loop.run_until_complete(client.close())
+        loop.close()
 
 
 if __name__ == "__main__":